@@ -35,6 +35,9 @@ class PasswordServer(object):
         message = ('Warning: do not enter your password if anyone else has'
                 ' superuser privileges or access to your account.')
         print(textwrap.fill(message))
+        # Task output bypasses the text layer of stdout, so flush it now to
+        # keep the warning ahead of that output.
+        sys.stdout.flush()
 
         self.password = getpass.getpass()
 
@@ -14,6 +14,7 @@ except ImportError:
 
 from psshlib.askpass_server import PasswordServer
 from psshlib import psshutil
+from psshlib.task import FILE_BATCH_DELAY
 
 READ_SIZE = 1 << 16
 
@@ -71,7 +72,12 @@ class Manager(object):
                     # Opt for efficiency over subsecond timeout accuracy.
                     if wait is None or wait < 1:
                         wait = 1
+                    # Wake up regularly to hand batched output to the Writer.
+                    if writer and wait > FILE_BATCH_DELAY:
+                        wait = FILE_BATCH_DELAY
                     self.iomap.poll(wait)
+                    if writer:
+                        self.flush_files(FILE_BATCH_DELAY)
                     self.update_tasks(writer)
                     wait = self.check_timeout()
             except KeyboardInterrupt:
@@ -81,8 +87,9 @@ class Manager(object):
 
         except KeyboardInterrupt:
             # This exception handler doesn't print out any fancy status
-            # information--it just stops.
-            pass
+            # information--it just stops, but without losing output that
+            # tasks have batched for the Writer.
+            self.flush_files()
 
         if writer:
             writer.signal_quit()
@@ -181,6 +188,14 @@ class Manager(object):
         else:
             return max(0, min_timeleft)
 
+    def flush_files(self, age=0):
+        """Hands output batched by running tasks to the Writer.
+
+        Only batches that have waited at least `age` seconds are handed over.
+        """
+        for task in self.running:
+            task.flush_files(age)
+
     def interrupted(self):
         """Cleans up after a keyboard interrupt."""
         for task in self.running:
@@ -209,6 +224,8 @@ class IOMap(object):
 
         # Setup the wakeup file descriptor to avoid hanging on lost signals.
         wakeup_readfd, wakeup_writefd = os.pipe()
+        # Python 3 refuses a blocking wakeup fd.
+        psshutil.set_nonblocking(wakeup_writefd)
         self.register_read(wakeup_readfd, self.wakeup_handler)
         # TODO: remove test when we stop supporting Python <2.5
         if hasattr(signal, 'set_wakeup_fd'):
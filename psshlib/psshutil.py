@@ -2,6 +2,7 @@
 # Copyright (c) 2003-2008, Brent N. Chun
 
 import fcntl
+import os
 import string
 import sys
 
@@ -106,3 +107,16 @@ def set_cloexec(filelike):
     not require the close_fds option.
     """
     fcntl.fcntl(filelike.fileno(), fcntl.FD_CLOEXEC, 1)
+
+
+def set_nonblocking(filelike):
+    """Puts the underlying filedescriptor in non-blocking mode.
+
+    A plain filedescriptor may also be given.
+    """
+    try:
+        fd = filelike.fileno()
+    except AttributeError:
+        fd = filelike
+    flags = fcntl.fcntl(fd, fcntl.F_GETFL)
+    fcntl.fcntl(fd, fcntl.F_SETFL, flags | os.O_NONBLOCK)
@@ -1,6 +1,6 @@
 # Copyright (c) 2009-2012, Andrew McNabb
 
-from errno import EINTR
+from errno import EAGAIN, EINTR
 from subprocess import Popen, PIPE
 import os
 import signal
@@ -10,14 +10,39 @@ import traceback
 
 from psshlib import askpass_client
 from psshlib import color
+from psshlib import psshutil
 
 BUFFER_SIZE = 1 << 16
+# The stdout and stderr pipes are non-blocking, so each readable event keeps
+# reading while reads come back full, up to this many times.
+READS_PER_EVENT = 8
+# Output for the outdir and errdir files is handed to the Writer in batches
+# of at least this many bytes, or once the oldest batched chunk has waited
+# this many seconds (or when the stream closes).
+FILE_BATCH_SIZE = 1 << 18
+FILE_BATCH_DELAY = 1
 
 try:
     bytes
 except NameError:
     bytes = str
 
+try:
+    memoryview
+except NameError:
+    memoryview = None
+
+NEWLINE = '\n'.encode('ascii')
+
+# The environment shared by all subprocesses, built by base_environ().
+_base_environ = None
+# The (possibly colored) report templates, built by report_styles().
+_report_styles = None
+# Whether stdout is a terminal, checked by stdout_is_tty().
+_stdout_is_tty = None
+# The most recent (seconds, string) pair formatted by timestamp().
+_timestamp = (None, '')
+
 
 class Task(object):
     """Starts a process and manages its input and output.
@@ -44,15 +69,28 @@ class Task(object):
         self.failures = []
         self.killed = False
         self.inputbuffer = stdin
+        self.inputview = None
         self.byteswritten = 0
-        self.outputbuffer = bytes()
-        self.errorbuffer = bytes()
+        # Inline output is kept as a list of chunks and joined in report()
+        # to avoid recopying the accumulated output on every read.
+        self.outputbuffer = []
+        self.errorbuffer = []
 
         self.stdin = None
         self.stdout = None
         self.stderr = None
+        # File descriptors are saved to avoid repeated fileno() calls.
+        self.stdin_fd = None
+        self.stdout_fd = None
+        self.stderr_fd = None
         self.outfile = None
         self.errfile = None
+        self.outfile_chunks = []
+        self.outfile_size = 0
+        self.outfile_time = None
+        self.errfile_chunks = []
+        self.errfile_size = 0
+        self.errfile_time = None
 
         # Set options.
         self.verbose = opts.verbose
@@ -60,6 +98,8 @@ class Task(object):
             self.print_out = bool(opts.print_out)
         except AttributeError:
             self.print_out = False
+        # The host prefix for printed output is fixed, so encode it once.
+        self.print_prefix = encode('%s: ' % self.host)
         try:
             self.inline = bool(opts.inline)
         except AttributeError:
@@ -68,6 +108,12 @@ class Task(object):
             self.inline_stdout = bool(opts.inline_stdout)
         except AttributeError:
             self.inline_stdout = False
+        # Decide once whether stdout is kept for report() rather than
+        # re-evaluating both options on every read.
+        self.buffer_stdout = self.inline or self.inline_stdout
+        # Output is only flushed as it is written if stdout is a terminal;
+        # otherwise the stream's own buffering batches the writes.
+        self.flush_output = stdout_is_tty()
 
     def start(self, nodenum, iomap, writer, askpass_socket=None):
         """Starts the process and registers files with the IOMap."""
@@ -77,21 +123,13 @@ class Task(object):
             self.outfile, self.errfile = writer.open_files(self.pretty_host)
 
         # Set up the environment.
-        environ = dict(os.environ)
+        environ = base_environ().copy()
         environ['PSSH_NODENUM'] = str(nodenum)
         environ['PSSH_HOST'] = self.host
-        # Disable the GNOME pop-up password dialog and allow ssh to use
-        # askpass.py to get a provided password.  If the module file is
-        # askpass.pyc, we replace the extension.
-        environ['SSH_ASKPASS'] = askpass_client.executable_path()
         if askpass_socket:
             environ['PSSH_ASKPASS_SOCKET'] = askpass_socket
         if self.verbose:
             environ['PSSH_ASKPASS_VERBOSE'] = '1'
-        # Work around a mis-feature in ssh where it won't call SSH_ASKPASS
-        # if DISPLAY is unset.
-        if 'DISPLAY' not in environ:
-            environ['DISPLAY'] = 'pssh-gibberish'
 
         # Create the subprocess.  Since we carefully call set_cloexec() on
         # all open files, we specify close_fds=False.
@@ -99,14 +137,24 @@ class Task(object):
                 close_fds=False, preexec_fn=os.setsid, env=environ)
         self.timestamp = time.time()
         if self.inputbuffer:
+            # Slicing a memoryview does not copy the input on each write.
+            if memoryview:
+                self.inputview = memoryview(self.inputbuffer)
+            else:
+                self.inputview = self.inputbuffer
             self.stdin = self.proc.stdin
-            iomap.register_write(self.stdin.fileno(), self.handle_stdin)
+            self.stdin_fd = self.stdin.fileno()
+            iomap.register_write(self.stdin_fd, self.handle_stdin)
         else:
             self.proc.stdin.close()
         self.stdout = self.proc.stdout
-        iomap.register_read(self.stdout.fileno(), self.handle_stdout)
+        self.stdout_fd = self.stdout.fileno()
+        psshutil.set_nonblocking(self.stdout)
+        iomap.register_read(self.stdout_fd, self.handle_stdout)
         self.stderr = self.proc.stderr
-        iomap.register_read(self.stderr.fileno(), self.handle_stderr)
+        self.stderr_fd = self.stderr.fileno()
+        psshutil.set_nonblocking(self.stderr)
+        iomap.register_read(self.stderr_fd, self.handle_stderr)
 
     def _kill(self):
         """Signals the process to terminate."""
@@ -129,6 +177,8 @@ class Task(object):
         if not self.killed:
             self._kill()
             self.failures.append('Interrupted')
+        # The streams will not be closed, so write out any batched output.
+        self.flush_files()
 
     def cancel(self):
         """Stops a task that has not started."""
@@ -166,7 +216,7 @@ class Task(object):
         try:
             start = self.byteswritten
             if start < len(self.inputbuffer):
-                chunk = self.inputbuffer[start:start+BUFFER_SIZE]
+                chunk = self.inputview[start:start+BUFFER_SIZE]
                 self.byteswritten = start + os.write(fd, chunk)
             else:
                 self.close_stdin(iomap)
@@ -178,63 +228,125 @@ class Task(object):
 
     def close_stdin(self, iomap):
         if self.stdin:
-            iomap.unregister(self.stdin.fileno())
+            iomap.unregister(self.stdin_fd)
             self.stdin.close()
             self.stdin = None
+            self.inputview = None
 
     def handle_stdout(self, fd, iomap):
         """Called when the process's standard output is ready for reading."""
         try:
-            buf = os.read(fd, BUFFER_SIZE)
-            if buf:
-                if self.inline or self.inline_stdout:
-                    self.outputbuffer += buf
+            for i in range(READS_PER_EVENT):
+                buf = os.read(fd, BUFFER_SIZE)
+                if not buf:
+                    self.close_stdout(iomap)
+                    break
+                if self.buffer_stdout:
+                    self.outputbuffer.append(buf)
                 if self.outfile:
-                    self.writer.write(self.outfile, buf)
+                    if not self.outfile_chunks:
+                        self.outfile_time = time.time()
+                    self.outfile_chunks.append(buf)
+                    self.outfile_size += len(buf)
+                    if self.outfile_size >= FILE_BATCH_SIZE:
+                        self.flush_outfile()
                 if self.print_out:
-                    sys.stdout.write('%s: %s' % (self.host, buf))
-                    if buf[-1] != '\n':
-                        sys.stdout.write('\n')
-            else:
-                self.close_stdout(iomap)
+                    self.print_output(buf)
+                # A short read means the pipe has been drained.
+                if len(buf) < BUFFER_SIZE:
+                    break
         except (OSError, IOError):
             _, e, _ = sys.exc_info()
-            if e.errno != EINTR:
+            # EAGAIN just means that the pipe has been drained.
+            if e.errno not in (EINTR, EAGAIN):
                 self.close_stdout(iomap)
                 self.log_exception(e)
 
+    def print_output(self, buf):
+        """Prints a chunk of standard output prefixed with the host name.
+
+        The whole record is assembled in memory and written in one call.
+        """
+        record = [self.print_prefix, buf]
+        if not buf.endswith(NEWLINE):
+            record.append(NEWLINE)
+        out = stdout_buffer()
+        write_all(out, bytes().join(record))
+        if self.flush_output:
+            out.flush()
+
+    def flush_files(self, age=0):
+        """Hands batched output for the outdir and errdir files to the Writer.
+
+        Only batches whose oldest chunk has waited at least `age` seconds are
+        handed over.
+        """
+        if not self.outfile_chunks and not self.errfile_chunks:
+            return
+        now = time.time()
+        if self.outfile_chunks and now - self.outfile_time >= age:
+            self.flush_outfile()
+        if self.errfile_chunks and now - self.errfile_time >= age:
+            self.flush_errfile()
+
+    def flush_outfile(self):
+        """Hands the batched standard output to the Writer in one write."""
+        if self.outfile_chunks:
+            self.writer.write(self.outfile, bytes().join(self.outfile_chunks))
+            self.outfile_chunks = []
+            self.outfile_size = 0
+
     def close_stdout(self, iomap):
         if self.stdout:
-            iomap.unregister(self.stdout.fileno())
+            iomap.unregister(self.stdout_fd)
             self.stdout.close()
             self.stdout = None
         if self.outfile:
+            self.flush_outfile()
             self.writer.close(self.outfile)
             self.outfile = None
 
     def handle_stderr(self, fd, iomap):
         """Called when the process's standard error is ready for reading."""
         try:
-            buf = os.read(fd, BUFFER_SIZE)
-            if buf:
+            for i in range(READS_PER_EVENT):
+                buf = os.read(fd, BUFFER_SIZE)
+                if not buf:
+                    self.close_stderr(iomap)
+                    break
                 if self.inline:
-                    self.errorbuffer += buf
+                    self.errorbuffer.append(buf)
                 if self.errfile:
-                    self.writer.write(self.errfile, buf)
-            else:
-                self.close_stderr(iomap)
+                    if not self.errfile_chunks:
+                        self.errfile_time = time.time()
+                    self.errfile_chunks.append(buf)
+                    self.errfile_size += len(buf)
+                    if self.errfile_size >= FILE_BATCH_SIZE:
+                        self.flush_errfile()
+                # A short read means the pipe has been drained.
+                if len(buf) < BUFFER_SIZE:
+                    break
         except (OSError, IOError):
             _, e, _ = sys.exc_info()
-            if e.errno != EINTR:
+            # EAGAIN just means that the pipe has been drained.
+            if e.errno not in (EINTR, EAGAIN):
                 self.close_stderr(iomap)
                 self.log_exception(e)
 
+    def flush_errfile(self):
+        """Hands the batched standard error to the Writer in one write."""
+        if self.errfile_chunks:
+            self.writer.write(self.errfile, bytes().join(self.errfile_chunks))
+            self.errfile_chunks = []
+            self.errfile_size = 0
+
     def close_stderr(self, iomap):
         if self.stderr:
-            iomap.unregister(self.stderr.fileno())
+            iomap.unregister(self.stderr_fd)
             self.stderr.close()
             self.stderr = None
         if self.errfile:
+            self.flush_errfile()
             self.writer.close(self.errfile)
             self.errfile = None
 
@@ -251,38 +363,124 @@ class Task(object):
     def report(self, n):
         """Pretty prints a status report after the Task completes."""
         error = ', '.join(self.failures)
-        tstamp = time.asctime().split()[3] # Current time
-        if color.has_colors(sys.stdout):
-            progress = color.c("[%s]" % color.B(n))
-            success = color.g("[%s]" % color.B("SUCCESS"))
-            failure = color.r("[%s]" % color.B("FAILURE"))
-            stderr = color.r("Stderr: ")
-            error = color.r(color.B(error))
-        else:
-            progress = "[%s]" % n
-            success = "[SUCCESS]"
-            failure = "[FAILURE]"
-            stderr = "Stderr: "
+        tstamp = timestamp()
+        progress, success, failure, stderr, error_format = report_styles()
+        progress = progress % n
+        error = error_format % error
         host = self.pretty_host
         if self.failures:
-            print(' '.join((progress, tstamp, failure, host, error)))
+            line = ' '.join((progress, tstamp, failure, host, error))
         else:
-            print(' '.join((progress, tstamp, success, host)))
-        # NOTE: The extra flushes are to ensure that the data is output in
-        # the correct order with the C implementation of io.
-        if self.outputbuffer:
-            sys.stdout.flush()
-            try:
-                sys.stdout.buffer.write(self.outputbuffer)
-                sys.stdout.flush()
-            except AttributeError:
-                sys.stdout.write(self.outputbuffer)
+            line = ' '.join((progress, tstamp, success, host))
+        # The whole report is assembled in memory and written in one call
+        # through the binary buffer so that it stays in the correct order.
+        # It is always flushed so that results appear as hosts finish, even
+        # when stdout is a pipe (e.g., into tee).
+        record = [encode(line + '\n')]
+        record.extend(self.outputbuffer)
         if self.errorbuffer:
-            sys.stdout.write(stderr)
-            # Flush the TextIOWrapper before writing to the binary buffer.
-            sys.stdout.flush()
-            try:
-                sys.stdout.buffer.write(self.errorbuffer)
-            except AttributeError:
-                sys.stdout.write(self.errorbuffer)
+            record.append(encode(stderr))
+            record.extend(self.errorbuffer)
+        out = stdout_buffer()
+        write_all(out, bytes().join(record))
+        out.flush()
+
+
+def base_environ():
+    """Returns the environment variables common to every Task.
+
+    The dictionary is built on the first call and reused afterwards, so it
+    must be copied before it is modified.
+    """
+    global _base_environ
+    if _base_environ is None:
+        environ = dict(os.environ)
+        # Disable the GNOME pop-up password dialog and allow ssh to use
+        # askpass.py to get a provided password.  If the module file is
+        # askpass.pyc, we replace the extension.
+        environ['SSH_ASKPASS'] = askpass_client.executable_path()
+        # Work around a mis-feature in ssh where it won't call SSH_ASKPASS
+        # if DISPLAY is unset.
+        if 'DISPLAY' not in environ:
+            environ['DISPLAY'] = 'pssh-gibberish'
+        _base_environ = environ
+    return _base_environ
+
+
+def report_styles():
+    """Returns the templates used by Task.report().
+
+    The result is a tuple (progress, success, failure, stderr, error), where
+    progress and error are format strings.  Whether stdout supports color is
+    only checked on the first call.
+    """
+    global _report_styles
+    if _report_styles is None:
+        if color.has_colors(sys.stdout):
+            _report_styles = (color.c("[%s]" % color.B("%s")),
+                    color.g("[%s]" % color.B("SUCCESS")),
+                    color.r("[%s]" % color.B("FAILURE")),
+                    color.r("Stderr: "),
+                    color.r(color.B("%s")))
+        else:
+            _report_styles = ("[%s]", "[SUCCESS]", "[FAILURE]", "Stderr: ",
+                    "%s")
+    return _report_styles
+
+
+def timestamp():
+    """Returns the current local time as HH:MM:SS.
+
+    The string is only reformatted when the second changes, since many tasks
+    often finish within the same second.
+    """
+    global _timestamp
+    now = int(time.time())
+    if now != _timestamp[0]:
+        _timestamp = (now, time.strftime('%H:%M:%S', time.localtime(now)))
+    return _timestamp[1]
+
+
+def stdout_is_tty():
+    """Returns whether stdout is a terminal.
+
+    This is only checked on the first call.
+    """
+    global _stdout_is_tty
+    if _stdout_is_tty is None:
+        try:
+            _stdout_is_tty = sys.stdout.isatty()
+        except AttributeError:
+            _stdout_is_tty = False
+    return _stdout_is_tty
+
+
+def stdout_buffer():
+    """Returns a file object for writing bytes to standard output."""
+    try:
+        return sys.stdout.buffer
+    except AttributeError:
+        return sys.stdout
+
+
+def write_all(out, data):
+    """Writes all of the given bytes to a file object from stdout_buffer().
+
+    When Python 3 runs unbuffered (-u or PYTHONUNBUFFERED), sys.stdout.buffer
+    is a raw FileIO, and a write that a signal such as SIGCHLD interrupts may
+    accept only part of the data.  The rest is written again.
+    """
+    while True:
+        written = out.write(data)
+        # Python 2 file objects always write everything and return None.
+        if written is None or written >= len(data):
+            break
+        # Short writes only happen on Python 3, which has memoryview.
+        data = memoryview(data)[written:]
+
 
+def encode(text):
+    """Converts text to bytes suitable for writing to stdout_buffer()."""
+    if isinstance(text, bytes):
+        return text
+    return text.encode(sys.stdout.encoding or 'utf-8')
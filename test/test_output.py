@@ -0,0 +1,87 @@
+#!/usr/bin/python
+
+# Copyright (c) 2009-2012, Andrew McNabb
+
+"""Tests of the local output path that do not need any remote hosts."""
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+import unittest
+
+basedir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Runs a few local tasks through the Manager, each running the given shell
+# command.
+RUNNER = """
+import optparse
+import sys
+sys.path.insert(0, %(basedir)r)
+from psshlib.manager import Manager
+from psshlib.task import Task
+
+opts = optparse.Values(dict(par=%(tasks)d, timeout=0, askpass=False,
+        outdir=%(outdir)r, errdir=None, verbose=False, user=None,
+        print_out=%(print_out)r, inline=%(inline)r, inline_stdout=False))
+manager = Manager(opts)
+for i in range(%(tasks)d):
+    cmd = ['sh', '-c', %(cmd)r]
+    manager.add_task(Task('host%%d' %% i, None, None, cmd, opts))
+manager.run()
+"""
+
+class OutputTest(unittest.TestCase):
+    def run_tasks(self, tasks, size, print_out, inline):
+        """Runs the tasks with stdout piped to a slow reader.
+
+        Returns the number of "x" characters that arrived on stdout.
+        """
+        cmd = 'head -c %d /dev/zero | tr "\\0" x' % size
+        script = RUNNER % dict(basedir=basedir, tasks=tasks, cmd=cmd,
+                outdir=None, print_out=print_out, inline=inline)
+        # Short writes only happen with the raw, unbuffered stdout.
+        env = dict(os.environ, PYTHONUNBUFFERED='1')
+        proc = subprocess.Popen([sys.executable, '-c', script],
+                stdout=subprocess.PIPE, stderr=open(os.devnull, 'w'), env=env)
+        count = 0
+        while True:
+            data = proc.stdout.read(4096)
+            if not data:
+                break
+            count += data.count('x'.encode('ascii'))
+            # Let the writer block so that SIGCHLD arrives mid-write.
+            time.sleep(0.0005)
+        proc.wait()
+        self.assertEqual(proc.returncode, 0)
+        return count
+
+    def testPrintPiped(self):
+        count = self.run_tasks(32, 200000, True, False)
+        self.assertEqual(count, 32 * 200000)
+
+    def testInlinePiped(self):
+        count = self.run_tasks(12, 600000, False, True)
+        self.assertEqual(count, 12 * 600000)
+
+    def testOutdirLive(self):
+        outdir = tempfile.mkdtemp()
+        try:
+            script = RUNNER % dict(basedir=basedir, tasks=1,
+                    cmd='echo hello; sleep 4', outdir=outdir,
+                    print_out=False, inline=False)
+            proc = subprocess.Popen([sys.executable, '-c', script],
+                    stdout=open(os.devnull, 'w'), stderr=subprocess.STDOUT)
+            # Output should reach the file well before the task finishes.
+            time.sleep(2.5)
+            data = open(os.path.join(outdir, 'host0')).read()
+            proc.wait()
+            self.assertEqual(proc.returncode, 0)
+            self.assertEqual(data, 'hello\n')
+        finally:
+            shutil.rmtree(outdir)
+
+if __name__ == '__main__':
+    unittest.main()